@@ -0,0 +1,266 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import importlib.util
+import logging
+import resource
+import subprocess
+import bids
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, script_dir)
+import synthetic_dataset
+
+BASELINES_PATH = os.path.join(script_dir, 'baselines.json')
+# timings vary by up to ~30% between runs on a shared machine, memory by less than 1%
+TIME_TOLERANCE = 0.5
+# seconds, timer resolution and noise on the shortest stages
+TIME_SLACK = 0.05
+MEMORY_TOLERANCE = 0.2
+N_REGISTRATIONS = 2
+REPEATS = 3
+
+SCRIPTS = {
+    'heuristics_unf': '../mri/convert/heuristics_unf.py',
+    'fill_intended_for': '../mri/prepare/fill_intended_for.py',
+    'deface_anat': '../mri/prepare/deface_anat.py',
+    'fmriprep': '../derivatives/fmriprep/fmriprep.py',
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description='time ds_prep stages on a synthetic dataset and compare with stored baselines')
+    parser.add_argument('--subjects', type=int, default=2)
+    parser.add_argument('--sessions', type=int, default=2)
+    parser.add_argument('--runs', type=int, default=2)
+    parser.add_argument(
+        '--stages', action='store', nargs='+',
+        help='stages to run, default is all')
+    parser.add_argument(
+        '--repeat', action='store', type=int, default=REPEATS,
+        help='number of timings of each stage, the fastest is kept')
+    parser.add_argument(
+        '--update-baselines', action='store_true',
+        help='store the results as the new baselines for this scale')
+    parser.add_argument(
+        '--keep-dataset', action='store',
+        help='generate the synthetic dataset in this folder and keep it')
+    # internal: run a single stage on an existing dataset, in a subprocess of the main run
+    parser.add_argument('--stage-worker', action='store', help=argparse.SUPPRESS)
+    parser.add_argument('--worker-dataset', action='store', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def load_script(name):
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(script_dir, SCRIPTS[name]))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# each stage is a (setup, run) pair: fixtures are built by setup, only run is timed
+def setup_heuristics(root, args):
+    heuristics_unf = load_script('heuristics_unf')
+    seqinfos = synthetic_dataset.fake_seqinfos(root, args.runs)
+    return heuristics_unf, seqinfos
+
+
+def bench_heuristics(ctx, args):
+    heuristics_unf, seqinfos = ctx
+    n_sessions = args.subjects * args.sessions
+    for _ in range(n_sessions):
+        heuristics_unf.infotodict(seqinfos)
+    return n_sessions * len(seqinfos), 'series'
+
+
+def setup_layout(root, args):
+    return root
+
+
+def bench_layout(root, args):
+    layout = bids.BIDSLayout(root, validate=False)
+    return len(layout.get(extension='.nii.gz')), 'images'
+
+
+def setup_intended_for(root, args):
+    return load_script('fill_intended_for'), root
+
+
+def bench_intended_for(ctx, args):
+    fill_intended_for, root = ctx
+    fill_intended_for.fill_intended_for(root)
+    return args.subjects * args.sessions * args.runs * len(synthetic_dataset.TASKS), 'bolds'
+
+
+def setup_registration(root, args):
+    deface_anat = load_script('deface_anat')
+    layout = bids.BIDSLayout(root, validate=False)
+    template = synthetic_dataset.synthetic_template()
+    template.get_fdata()
+    template_mask = deface_anat.generate_deface_ear_mask(synthetic_dataset.mni_grid())
+    anats = [anat.get_image() for anat in layout.get(suffix='T1w', extension='.nii.gz')[:N_REGISTRATIONS]]
+    for anat in anats:
+        anat.get_fdata()
+    return deface_anat, template, template_mask, anats
+
+
+def bench_registration(ctx, args):
+    deface_anat, template, template_mask, anats = ctx
+    for anat in anats:
+        affine = deface_anat.registration(template, anat)
+        deface_anat.warp_mask(template_mask, anat, affine)
+    return len(anats), 'registrations'
+
+
+def bench_fast_registration(ctx, args):
+    deface_anat, template, template_mask, anats = ctx
+    for anat in anats:
+        affine, _, _ = deface_anat.fast_registration(template, anat)
+        deface_anat.warp_mask(template_mask, anat, affine)
+    return len(anats), 'registrations'
+
+
+def setup_job_planning(root, args):
+    fmriprep = load_script('fmriprep')
+    layout = bids.BIDSLayout(root, validate=False)
+    os.makedirs(os.path.join(root, fmriprep.SLURM_JOB_DIR), exist_ok=True)
+    return fmriprep, layout
+
+
+def bench_job_planning(ctx, args):
+    fmriprep, layout = ctx
+    job_args = argparse.Namespace(email='bench@localhost')
+    n_jobs = 0
+    for subject in layout.get_subjects():
+        fmriprep.write_anat_job(layout, subject, job_args)
+        n_jobs += 1
+        for session in layout.get_sessions(subject=subject):
+            fmriprep.write_func_job(layout, subject, session, job_args)
+            n_jobs += 1
+    return n_jobs, 'jobs'
+
+
+STAGES = {
+    'heuristics': (setup_heuristics, bench_heuristics),
+    'layout_indexing': (setup_layout, bench_layout),
+    'intended_for': (setup_intended_for, bench_intended_for),
+    'registration_masking': (setup_registration, bench_registration),
+    'fast_registration_masking': (setup_registration, bench_fast_registration),
+    'job_planning': (setup_job_planning, bench_job_planning),
+}
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux, bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2**20 if sys.platform == 'darwin' else maxrss / 2**10
+
+
+def stage_worker(stage, root, args):
+    # runs in its own process, so that the peak RSS is the one of that stage only
+    setup, bench = STAGES[stage]
+    ctx = setup(root, args)
+    # fastest of the repeats, the others are slowed down by the rest of the system
+    elapsed, cpu_elapsed = float('inf'), float('inf')
+    for _ in range(args.repeat):
+        start, cpu_start = time.perf_counter(), time.process_time()
+        n_items, unit = bench(ctx, args)
+        elapsed = min(elapsed, time.perf_counter() - start)
+        cpu_elapsed = min(cpu_elapsed, time.process_time() - cpu_start)
+    print(json.dumps({
+        'seconds': elapsed,
+        'cpu_seconds': cpu_elapsed,
+        'peak_mb': _peak_rss_mb(),
+        'items': n_items,
+        'unit': unit,
+        'throughput': n_items / elapsed if elapsed else float('inf'),
+    }))
+
+
+def run_stage(stage, root, args):
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__),
+         '--subjects', str(args.subjects),
+         '--sessions', str(args.sessions),
+         '--runs', str(args.runs),
+         '--repeat', str(args.repeat),
+         '--stage-worker', stage, '--worker-dataset', root],
+        capture_output=True, text=True)
+    if proc.returncode:
+        print(proc.stderr, file=sys.stderr)
+        return None
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def compare_baseline(stage, result, baseline):
+    regressions = []
+    # cpu time is compared, wall time also depends on the load of the machine
+    if result['cpu_seconds'] > baseline['cpu_seconds'] * (1 + TIME_TOLERANCE) + TIME_SLACK:
+        regressions.append("%s: %.2fs cpu vs baseline %.2fs" % (
+            stage, result['cpu_seconds'], baseline['cpu_seconds']))
+    if result['peak_mb'] > baseline['peak_mb'] * (1 + MEMORY_TOLERANCE):
+        regressions.append("%s: %.1fMB peak vs baseline %.1fMB" % (stage, result['peak_mb'], baseline['peak_mb']))
+    return regressions
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.stage_worker:
+        stage_worker(args.stage_worker, args.worker_dataset, args)
+        return
+
+    scale = f"{args.subjects}x{args.sessions}x{args.runs}"
+    baselines = {}
+    if os.path.exists(BASELINES_PATH):
+        with open(BASELINES_PATH, 'r') as fd:
+            baselines = json.load(fd)
+    scale_baselines = baselines.get(scale, {})
+
+    root = args.keep_dataset or tempfile.mkdtemp(prefix='ds_prep_bench_')
+    synthetic_dataset.make_bids_dataset(root, args.subjects, args.sessions, args.runs)
+
+    # failed stages, stages without baseline and regressions all fail the run
+    results, regressions = {}, []
+    try:
+        for stage in args.stages or STAGES:
+            result = run_stage(stage, root, args)
+            if result is None:
+                regressions.append("%s: stage failed" % stage)
+                continue
+            results[stage] = result
+            print("%-26s %8.2fs %8.2fs cpu %8.1fMB %10.1f %s/s" % (
+                stage, result['seconds'], result['cpu_seconds'], result['peak_mb'],
+                result['throughput'], result['unit']))
+            if args.update_baselines:
+                continue
+            if stage in scale_baselines:
+                regressions.extend(compare_baseline(stage, result, scale_baselines[stage]))
+            else:
+                regressions.append("%s: no baseline for scale %s, run with --update-baselines" % (stage, scale))
+    finally:
+        if not args.keep_dataset:
+            shutil.rmtree(root)
+
+    if args.update_baselines:
+        baselines[scale] = dict(scale_baselines, **results)
+        with open(BASELINES_PATH, 'w') as fd:
+            json.dump(baselines, fd, indent=2, sort_keys=True)
+            fd.write('\n')
+
+    if regressions:
+        for regression in regressions:
+            print("FAIL " + regression, file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
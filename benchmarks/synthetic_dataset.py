@@ -0,0 +1,166 @@
+import os
+import json
+import argparse
+import types
+import numpy as np
+import nibabel as nb
+import pydicom
+from pydicom.dataset import Dataset, FileDataset
+
+TASKS = ['rest', 'motor']
+ANAT_SHAPE = (64, 64, 64)
+BOLD_SHAPE = (16, 16, 12, 10)
+TEMPLATE_SHAPE = (91, 109, 91)
+# grid of the 1mm MNI template, the deface mask markers are set in its voxels
+MNI_SHAPE = (182, 218, 182)
+MNI_ORIGIN = (-90., -126., -72.)
+SHIM_SETTINGS = [[-2580, -3940, -15025, 244, -68, -23, 14, 19], [-2590, -3951, -15010, 251, -70, -20, 12, 17]]
+IMAGE_ORIENTATION = [1, 0, 0, 0, 0.99, -0.13]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description='generate a synthetic BIDS dataset with fake DICOM headers for benchmarks')
+    parser.add_argument('output_path',
+                   help='folder to create the synthetic dataset in.')
+    parser.add_argument('--subjects', type=int, default=2)
+    parser.add_argument('--sessions', type=int, default=2)
+    parser.add_argument('--runs', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def ellipsoid_image(shape, voxel_size, center_shift, rng):
+    """Smooth head-like ellipsoid with noise, shifted to mimic head placement"""
+    grid = np.indices(shape).astype(np.float32)
+    center = np.asarray(shape) / 2. + center_shift
+    radii = np.asarray(shape) * np.asarray([0.35, 0.4, 0.38])
+    dist = np.sqrt(sum(((g - c) / r) ** 2 for g, c, r in zip(grid, center, radii)))
+    data = 1000. * np.clip(1.2 - dist, 0, 1) + rng.normal(0, 10, shape)
+    affine = np.diag(list(voxel_size) + [1.])
+    affine[:3, 3] = -np.asarray(shape) * voxel_size / 2.
+    return nb.Nifti1Image(data.astype(np.float32), affine)
+
+
+def synthetic_template():
+    return ellipsoid_image(TEMPLATE_SHAPE, (2., 2., 2.), np.zeros(3), np.random.default_rng(0))
+
+
+def mni_grid():
+    affine = np.eye(4)
+    affine[:3, 3] = MNI_ORIGIN
+    return nb.Nifti1Image(np.zeros(MNI_SHAPE, dtype=np.int8), affine)
+
+
+def write_json(path, meta):
+    with open(path, 'w') as fd:
+        json.dump(meta, fd, indent=3)
+
+
+def bold_sidecar(task, shim, pedir='j'):
+    return {
+        'RepetitionTime': 1.49,
+        'TaskName': task,
+        'PhaseEncodingDirection': pedir,
+        'ShimSetting': shim,
+        'global': {'const': {
+            'ImageOrientationPatient': IMAGE_ORIENTATION,
+            'ImagePositionPatient': [-100., -90., -60.]}},
+    }
+
+
+def make_session(root, subject, session, n_runs, rng):
+    prefix = f"sub-{subject}_ses-{session}"
+    sub_path = os.path.join(root, f"sub-{subject}", f"ses-{session}")
+    for datatype in ['anat', 'func', 'fmap']:
+        os.makedirs(os.path.join(sub_path, datatype), exist_ok=True)
+
+    anat = ellipsoid_image(ANAT_SHAPE, (3., 3., 3.), rng.normal(0, 2, 3), rng)
+    anat.to_filename(os.path.join(sub_path, 'anat', f"{prefix}_T1w.nii.gz"))
+    write_json(os.path.join(sub_path, 'anat', f"{prefix}_T1w.json"), {'RepetitionTime': 2.4})
+
+    shim = SHIM_SETTINGS[int(session) % len(SHIM_SETTINGS)]
+    bold_data = rng.normal(1000, 20, BOLD_SHAPE).astype(np.float32)
+    for task in TASKS:
+        for run in range(1, n_runs + 1):
+            base = f"{prefix}_task-{task}_run-{run:02d}"
+            nb.Nifti1Image(bold_data, np.eye(4)).to_filename(
+                os.path.join(sub_path, 'func', f"{base}_bold.nii.gz"))
+            write_json(os.path.join(sub_path, 'func', f"{base}_bold.json"), bold_sidecar(task, shim))
+            with open(os.path.join(sub_path, 'func', f"{base}_events.tsv"), 'w') as fd:
+                fd.write('onset\tduration\ttrial_type\n')
+                for i in range(10):
+                    fd.write(f"{i * 1.5:.1f}\t1.0\t{'left' if i % 2 else 'right'}\n")
+
+    for run, pedir in enumerate(['j', 'j-'], 1):
+        direction = 'PA' if pedir == 'j' else 'AP'
+        base = f"{prefix}_acq-bold_dir-{direction}_run-{run:02d}_epi"
+        nb.Nifti1Image(bold_data[..., :1], np.eye(4)).to_filename(
+            os.path.join(sub_path, 'fmap', f"{base}.nii.gz"))
+        write_json(os.path.join(sub_path, 'fmap', f"{base}.json"), bold_sidecar(None, shim, pedir))
+
+
+def make_bids_dataset(root, n_subjects, n_sessions, n_runs, seed=0):
+    rng = np.random.default_rng(seed)
+    os.makedirs(root, exist_ok=True)
+    write_json(os.path.join(root, 'dataset_description.json'),
+               {'Name': 'synthetic', 'BIDSVersion': '1.4.0'})
+    for sub in range(1, n_subjects + 1):
+        for ses in range(1, n_sessions + 1):
+            make_session(root, f"{sub:02d}", f"{ses:03d}", n_runs, rng)
+    return root
+
+
+def fake_dicom(path, patient_name, image_comments='', pedir='COL'):
+    file_meta = Dataset()
+    file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+    file_meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+    file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+    ds = FileDataset(path, {}, file_meta=file_meta, preamble=b'\0' * 128)
+    ds.PatientName = patient_name
+    ds.Modality = 'MR'
+    ds.BodyPartExamined = 'BRAIN'
+    ds.ImageComments = image_comments
+    ds.InPlanePhaseEncodingDirection = pedir
+    ds.save_as(path, write_like_original=False)
+    return path
+
+
+def fake_seqinfos(root, n_runs):
+    """Seqinfo-like records of a session, with fake DICOM headers, for heuristics_unf"""
+    dicom_dir = os.path.join(root, 'sourcedata', 'dicom')
+    os.makedirs(dicom_dir, exist_ok=True)
+    series = [('T1w_mprage', 'tfl3d1_16ns', 1, ''), ('fmap-epi_dir-AP', 'epfid2d1_96', 1, '')]
+    for task in TASKS:
+        for run in range(1, n_runs + 1):
+            series.append((f"func_task-{task}_run-{run:02d}", 'epfid2d1_96', 300, ''))
+            series.append((f"func_task-{task}_run-{run:02d}", 'epfid2d1_96', 1, 'Single-band reference'))
+
+    seqinfos = []
+    for idx, (protocol, sequence, dim4, comments) in enumerate(series):
+        dcm_path = fake_dicom(
+            os.path.join(dicom_dir, f"{idx:03d}.dcm"), 'neuromod_p01_mri001', comments)
+        seqinfos.append(types.SimpleNamespace(
+            series_id=f"{idx + 1}-{protocol}",
+            example_dcm_file_path=dcm_path,
+            protocol_name=protocol,
+            series_description=protocol,
+            sequence_name=sequence,
+            image_type=('ORIGINAL', 'PRIMARY', 'M', 'ND'),
+            dim4=dim4,
+            is_derived=False,
+            is_motion_corrected=False,
+            referring_physician_name='neuromod',
+            study_description='neuromod^synthetic'))
+    return seqinfos
+
+
+def main():
+    args = parse_args()
+    make_bids_dataset(args.output_path, args.subjects, args.sessions, args.runs, args.seed)
+    fake_seqinfos(args.output_path, args.runs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import os
+import glob
+import argparse
+import logging
+import concurrent.futures
+import numpy as np
+
+CONFOUNDS_TSV_SUFFIX = '_desc-confounds_timeseries.tsv'
+CONFOUNDS_NPZ_SUFFIX = '_desc-confounds_timeseries.npz'
+MOTION_PARAMS = ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description='store fmriprep confounds as compressed float32 columns (npz) next to the tsv')
+    parser.add_argument('derivatives_path',
+                   help='fmriprep derivatives folder.')
+    parser.add_argument(
+        '--participant-label', action='store', nargs='+',
+        help='a space delimited list of participant identifiers or a single '
+             'identifier (the sub- prefix can be removed)')
+    parser.add_argument(
+        '--remove-tsv', action='store_true',
+        help='remove the tsv once converted, only keeping the compressed columns')
+    parser.add_argument(
+        '--overwrite', action='store_true',
+        help='convert again confounds that already have a npz companion')
+    parser.add_argument('--nprocs', action='store', type=int,
+        help='number of processes, default is the number of CPUs')
+    return parser.parse_args()
+
+
+def find_confounds(derivatives_path, subjects=None, suffix=CONFOUNDS_TSV_SUFFIX):
+    subjects = ['sub-%s' % s.replace('sub-', '') for s in subjects] if subjects else ['sub-*']
+    paths = []
+    for sub in subjects:
+        paths.extend(glob.glob(
+            os.path.join(derivatives_path, sub, '**', 'func', '*' + suffix),
+            recursive=True))
+    return sorted(paths)
+
+
+def npz_up_to_date(tsv_path):
+    # fmriprep run again rewrites the tsv, its npz is then stale
+    npz_path = tsv_path.replace(CONFOUNDS_TSV_SUFFIX, CONFOUNDS_NPZ_SUFFIX)
+    if not os.path.exists(npz_path):
+        return False
+    return not os.path.exists(tsv_path) or os.path.getmtime(npz_path) >= os.path.getmtime(tsv_path)
+
+
+def read_confounds_tsv(tsv_path):
+    with open(tsv_path, 'r') as fd:
+        columns = fd.readline().rstrip('\n').split('\t')
+    data = np.genfromtxt(
+        tsv_path, delimiter='\t', skip_header=1, dtype=np.float32,
+        missing_values='n/a', filling_values=np.nan)
+    return columns, data.reshape(-1, len(columns))
+
+
+def convert_confounds(tsv_path, remove_tsv=False):
+    columns, data = read_confounds_tsv(tsv_path)
+    npz_path = tsv_path.replace(CONFOUNDS_TSV_SUFFIX, CONFOUNDS_NPZ_SUFFIX)
+    # each column is a separate compressed member of the archive, so it can be read alone
+    np.savez_compressed(npz_path, **{c: data[:, i] for i, c in enumerate(columns)})
+    if remove_tsv:
+        os.remove(tsv_path)
+    return npz_path
+
+
+def load_confounds(path, columns=None):
+    """Load confounds columns for a run as a dict of float32 arrays, from the npz or the tsv"""
+    if path.endswith(CONFOUNDS_TSV_SUFFIX):
+        if not npz_up_to_date(path):
+            all_columns, data = read_confounds_tsv(path)
+            columns = columns or all_columns
+            return {c: data[:, all_columns.index(c)] for c in columns}
+        path = path.replace(CONFOUNDS_TSV_SUFFIX, CONFOUNDS_NPZ_SUFFIX)
+    with np.load(path) as npz:
+        return {c: npz[c] for c in (columns or npz.files)}
+
+
+def load_all_confounds(derivatives_path, columns=MOTION_PARAMS, subjects=None):
+    """Load confounds columns for all runs of the derivatives, keyed by run tsv path"""
+    # runs are listed from both the tsv and npz, as tsv can be removed once converted
+    runs = set(find_confounds(derivatives_path, subjects, CONFOUNDS_TSV_SUFFIX))
+    runs.update(
+        p.replace(CONFOUNDS_NPZ_SUFFIX, CONFOUNDS_TSV_SUFFIX)
+        for p in find_confounds(derivatives_path, subjects, CONFOUNDS_NPZ_SUFFIX))
+    return {path: load_confounds(path, columns) for path in sorted(runs)}
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    tsv_paths = find_confounds(args.derivatives_path, args.participant_label)
+    if not args.overwrite:
+        tsv_paths = [p for p in tsv_paths if not npz_up_to_date(p)]
+    logging.info("converting %d confounds files" % len(tsv_paths))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.nprocs) as executor:
+        futures = {
+            executor.submit(convert_confounds, tsv_path, args.remove_tsv): tsv_path
+            for tsv_path in tsv_paths}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                logging.info("wrote %s" % future.result())
+            except Exception:
+                logging.exception("failed to convert %s" % futures[future])
+
+
+if __name__ == "__main__":
+    main()
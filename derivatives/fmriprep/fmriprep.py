@@ -6,6 +6,8 @@ import subprocess
 import json
 
 script_dir = os.path.dirname(__file__)
+sys.path.insert(0, os.path.join(script_dir, '../../global'))
+import instrument
 
 PYBIDS_CACHE_PATH = '.pybids_cache'
 SLURM_JOB_DIR = '.slurm'
@@ -140,7 +142,8 @@ def write_func_job(layout, subject, session, args):
     return job_path
 
 def submit_slurm_job(job_path):
-    return subprocess.run(f"sbatch {job_path}")
+    with instrument.span('submit', job=os.path.basename(job_path)):
+        return subprocess.run(f"sbatch {job_path}")
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -163,6 +166,7 @@ def parse_args():
     parser.add_argument(
         '--no-submit', action='store_true',
         help='Generate scripts, do not submit SLURM jobs, for testing.')
+    instrument.add_arguments(parser)
     return parser.parse_args()
 
 def run_smriprep(layout, args):
@@ -171,7 +175,9 @@ def run_smriprep(layout, args):
 
     for subject in subjects:
         #if TODO: check if derivative already exists for that subject
-        job_path = write_anat_job(layout, subject, args)
+        with instrument.span('write_job', subject=subject):
+            job_path = write_anat_job(layout, subject, args)
+        instrument.count('jobs')
         if not args.no_submit:
             submit_slurm_job(job_path)
 
@@ -184,22 +190,26 @@ def run_fmriprep(layout, args):
 
         sessions = layout.get_sessions(subject=subject)
         for session in sessions:
-            write_func_job(layout, subject, session, args)
+            with instrument.span('write_job', subject=subject, session=session):
+                job_path = write_func_job(layout, subject, session, args)
+            instrument.count('jobs')
             if not args.no_submit:
                 submit_slurm_job(job_path)
 
 def main():
 
     args = parse_args()
+    instrument.configure(args.metrics_file, args.profile)
 
     pybids_cache_path = os.path.join(args.bids_path, PYBIDS_CACHE_PATH)
 
-    layout = bids.BIDSLayout(
-        args.bids_path,
-        database_path=pybids_cache_path,
-        reset_database=args.force_reindex,
-        index_metadata=False,
-        validate=False)
+    with instrument.span('layout_indexing'):
+        layout = bids.BIDSLayout(
+            args.bids_path,
+            database_path=pybids_cache_path,
+            reset_database=args.force_reindex,
+            index_metadata=False,
+            validate=False)
 
     job_path = os.path.join(
         layout.root,
@@ -215,7 +225,8 @@ def main():
     # prefectch templateflow templates
     os.environ['TEMPLATEFLOW_HOME'] = TEMPLATEFLOW_HOME
     import templateflow.api as tf_api
-    tf_api.get(OUTPUT_TEMPLATES)
+    with instrument.span('templateflow_fetch'):
+        tf_api.get(OUTPUT_TEMPLATES)
 
     if args.preproc == 'anat':
         run_smriprep(layout, args)
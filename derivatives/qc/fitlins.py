@@ -0,0 +1,323 @@
+import os
+import csv
+import glob
+import json
+import hashlib
+import argparse
+import logging
+import subprocess
+import concurrent.futures
+import bids
+
+script_dir = os.path.dirname(__file__)
+
+PYBIDS_CACHE_PATH = '.pybids_cache'
+# database indexed inside the container, with the paths fitlins jobs see
+FITLINS_DB_PATH = '.pybids_cache_fitlins'
+SLURM_JOB_DIR = '.slurm'
+MODELS_DIR = 'models'
+# design digests of each job, moved to done/ by the job itself once fitlins succeeded
+DESIGN_CACHE_DIR = 'design_cache'
+
+FITLINS_REQ = {'cpus': 4, 'mem_per_cpu': 4096, 'time': '4:00:00'}
+
+FITLINS_VERSION = "fitlins-0.11.0"
+FITLINS_SINGULARITY_PATH = os.path.abspath(os.path.join(script_dir, f"../../containers/{FITLINS_VERSION}.simg"))
+SPACE = 'MNI152NLin2009cAsym'
+SMOOTHING = '5:run'
+CONFOUNDS = ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']
+
+slurm_preamble = """#!/bin/bash
+#SBATCH --account=rrg-pbellec
+#SBATCH --job-name={jobname}.job
+#SBATCH --output=.out/{jobname}_%a.out
+#SBATCH --error=.out/{jobname}_%a.err
+#SBATCH --time={time}
+#SBATCH --cpus-per-task={cpus}
+#SBATCH --mem-per-cpu={mem_per_cpu}M
+#SBATCH --array=0-{last_task}
+#SBATCH --mail-type=BEGIN
+#SBATCH --mail-type=END
+#SBATCH --mail-type=FAIL
+#SBATCH --mail-user={email}
+
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description='run fitlins basic contrasts for all subjects/sessions, locally or as a SLURM array')
+    parser.add_argument('bids_path',
+                   help='BIDS folder.')
+    parser.add_argument('fmriprep_path',
+                   help='fmriprep derivatives folder.')
+    parser.add_argument('output_path',
+                   help='fitlins output folder.')
+    parser.add_argument(
+        '--participant-label', action='store', nargs='+',
+        help='a space delimited list of participant identifiers or a single '
+             'identifier (the sub- prefix can be removed)')
+    parser.add_argument(
+        '--task', action='store', nargs='+',
+        help='tasks to generate models for, default is all tasks with events')
+    parser.add_argument(
+        '--force-reindex', action='store_true',
+        help='Force pyBIDS reset_database and reindexing')
+    parser.add_argument(
+        '--force', action='store_true',
+        help='refit all runs, even those with unchanged events and confounds')
+    parser.add_argument(
+        '--slurm', action='store_true',
+        help='submit a SLURM array job instead of running locally')
+    parser.add_argument(
+        '--email', action='store',
+        help='email for SLURM notifications')
+    parser.add_argument(
+        '--no-submit', action='store_true',
+        help='Generate scripts, do not submit SLURM jobs, for testing.')
+    parser.add_argument('--nprocs', action='store', type=int, default=1,
+        help='number of fitlins to run concurrently when running locally')
+    return parser.parse_args()
+
+
+def events_trial_types(events_files):
+    trial_types = set()
+    for events_file in events_files:
+        with open(events_file.path, 'r') as fd:
+            reader = csv.DictReader(fd, delimiter='\t')
+            trial_types.update(row['trial_type'] for row in reader if row.get('trial_type'))
+    return sorted(trial_types)
+
+
+def basic_contrasts_model(task, trial_types, confounds=CONFOUNDS):
+    conditions = ['trial_type.%s' % tt for tt in trial_types]
+    return {
+        "Name": f"{task}_basic_contrasts",
+        "BIDSModelVersion": "1.0.0",
+        "Input": {"task": [task]},
+        "Nodes": [
+            {
+                "Level": "Run",
+                "Name": "run",
+                "GroupBy": ["run", "session", "subject"],
+                "Transformations": {
+                    "Transformer": "pybids-transforms-v1",
+                    "Instructions": [
+                        {"Name": "Factor", "Input": ["trial_type"]},
+                        {"Name": "Convolve", "Input": conditions, "Model": "spm"},
+                    ]},
+                "Model": {"X": conditions + confounds + [1], "Type": "glm"},
+                "DummyContrasts": {"Contrasts": conditions, "Test": "t"},
+                "Contrasts": [{
+                    "Name": "task_vs_baseline",
+                    "ConditionList": conditions,
+                    "Weights": [1. / len(conditions)] * len(conditions),
+                    "Test": "t"}],
+            },
+            {
+                "Level": "Session",
+                "Name": "session",
+                "GroupBy": ["session", "subject", "contrast"],
+                "Model": {"X": [1], "Type": "meta"},
+                "DummyContrasts": {"Test": "t"},
+            },
+        ],
+    }
+
+
+def file_digest(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as fd:
+        for block in iter(lambda: fd.read(2**20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def preproc_files(events_file, layout, fmriprep_path):
+    # fmriprep outputs of the run, named after the events without the suffix
+    prefix = os.path.join(
+        fmriprep_path,
+        os.path.dirname(os.path.relpath(events_file.path, layout.root)),
+        os.path.basename(events_file.path)[:-len('_events.tsv')])
+    confounds = glob.glob(prefix + '_desc-confounds_timeseries.tsv')
+    bolds = glob.glob(prefix + '_space-%s_desc-preproc_bold.nii*' % SPACE)
+    return confounds, bolds
+
+
+def design_key(events_file, confounds, model, preproc):
+    # a run fit depends on its events, the confound set, the model and the fmriprep outputs
+    sha = hashlib.sha1(file_digest(events_file.path).encode())
+    sha.update(json.dumps(confounds).encode())
+    sha.update(json.dumps(model, sort_keys=True).encode())
+    confounds_files, bolds = preproc
+    for confounds_file in sorted(confounds_files):
+        sha.update(file_digest(confounds_file).encode())
+    # bold are too large to digest, fmriprep run again rewrites them
+    for bold in sorted(bolds):
+        stat = os.stat(bold)
+        sha.update(json.dumps([stat.st_mtime, stat.st_size]).encode())
+    return sha.hexdigest()
+
+
+def load_design_cache(output_path):
+    cache = {}
+    for digest_path in sorted(glob.glob(os.path.join(output_path, DESIGN_CACHE_DIR, 'done', '*.json'))):
+        with open(digest_path, 'r') as fd:
+            cache.update(json.load(fd))
+    return cache
+
+
+def singularity_cmd(args, layout):
+    return " ".join([
+        "singularity {} --cleanenv",
+        f"-B {layout.root}:/data",
+        f"-B {os.path.abspath(args.fmriprep_path)}:/fmriprep",
+        f"-B {os.path.abspath(args.output_path)}:/output",
+        FITLINS_SINGULARITY_PATH,
+        ])
+
+
+def index_in_container(args, layout):
+    # index once with the container pybids and paths, so that fitlins jobs can reuse the database
+    index_script = "; ".join([
+        "import bids",
+        "bids.BIDSLayout('/data', derivatives=['/fmriprep'], validate=False, "
+        f"database_path='/data/{FITLINS_DB_PATH}', reset_database={args.force_reindex})",
+        ])
+    subprocess.run(
+        singularity_cmd(args, layout).format('exec') + f' python -c "{index_script}"',
+        shell=True, check=True)
+
+
+def fitlins_cmd(args, layout, subject, job_name, session_model_path):
+    return " ".join([
+        singularity_cmd(args, layout).format('run'),
+        "/data", "/output", "participant",
+        f"--participant-label {subject}",
+        "--derivatives /fmriprep",
+        f"--database-path /data/{FITLINS_DB_PATH}",
+        f"--model /output/{os.path.relpath(session_model_path, args.output_path)}",
+        f"--space {SPACE}",
+        "--desc-label preproc",
+        f"--smoothing {SMOOTHING}",
+        # jobs of a subject run concurrently, they need separate nipype work dirs
+        f"--work-dir /output/work/{job_name}",
+        f"--n-cpus {FITLINS_REQ['cpus']}",
+        ])
+
+
+def plan_jobs(layout, args, design_cache):
+    models_path = os.path.join(args.output_path, MODELS_DIR)
+    os.makedirs(models_path, exist_ok=True)
+    for state in ['pending', 'done']:
+        os.makedirs(os.path.join(args.output_path, DESIGN_CACHE_DIR, state), exist_ok=True)
+    subjects = args.participant_label or layout.get_subjects()
+    tasks = args.task or layout.get_tasks(suffix='events')
+
+    cmds = []
+    for task in tasks:
+        events_files = layout.get(task=task, suffix='events', extension='.tsv', subject=subjects)
+        trial_types = events_trial_types(events_files)
+        if not trial_types:
+            logging.warning("no trial_type in %s events, skipping" % task)
+            continue
+        model = basic_contrasts_model(task, trial_types)
+        with open(os.path.join(models_path, f"task-{task}_model.json"), 'w') as f:
+            json.dump(model, f, indent=2)
+
+        sessions_to_fit = {}
+        for events_file in events_files:
+            key = design_key(
+                events_file, CONFOUNDS, model,
+                preproc_files(events_file, layout, args.fmriprep_path))
+            relpath = os.path.relpath(events_file.path, layout.root)
+            session_keys = sessions_to_fit.setdefault(
+                (events_file.entities['subject'], events_file.entities.get('session')), {})
+            session_keys[relpath] = key
+        # only refit sessions with at least one changed run
+        sessions_to_fit = {
+            ses: keys for ses, keys in sessions_to_fit.items()
+            if args.force or any(design_cache.get(r) != k for r, k in keys.items())}
+
+        for (subject, session), keys in sorted(sessions_to_fit.items(), key=lambda s: (s[0][0], s[0][1] or '')):
+            job_name = f"sub-{subject}_ses-{session}_task-{task}" if session else f"sub-{subject}_task-{task}"
+            session_model = dict(model)
+            session_model['Input'] = dict(model['Input'], subject=[subject])
+            if session:
+                session_model['Input']['session'] = [session]
+            session_model_path = os.path.join(models_path, f"{job_name}_model.json")
+            with open(session_model_path, 'w') as f:
+                json.dump(session_model, f, indent=2)
+
+            pending_path, done_path = [
+                os.path.abspath(os.path.join(args.output_path, DESIGN_CACHE_DIR, state, f"{job_name}.json"))
+                for state in ['pending', 'done']]
+            with open(pending_path, 'w') as f:
+                json.dump(keys, f, indent=1, sort_keys=True)
+            cmds.append(
+                fitlins_cmd(args, layout, subject, job_name, session_model_path) +
+                f" && mv {pending_path} {done_path}")
+    return cmds
+
+
+def write_array_job(layout, cmds, args):
+    job_dir = os.path.join(layout.root, SLURM_JOB_DIR)
+    os.makedirs(job_dir, exist_ok=True)
+    jobname = f"fitlins_study-{os.path.basename(layout.root)}"
+    cmds_path = os.path.join(job_dir, f"{jobname}_cmds.txt")
+    with open(cmds_path, 'w') as f:
+        f.write("\n".join(cmds) + "\n")
+
+    job_specs = dict(jobname=jobname, email=args.email, last_task=len(cmds) - 1)
+    job_specs.update(FITLINS_REQ)
+    job_path = os.path.join(job_dir, f"{jobname}.sh")
+    with open(job_path, 'w') as f:
+        f.write(slurm_preamble.format(**job_specs))
+        f.write(f'eval "$(sed -n "$((SLURM_ARRAY_TASK_ID+1))p" {cmds_path})"\n')
+    return job_path
+
+
+def run_local(cmds, nprocs):
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nprocs) as executor:
+        futures = {executor.submit(subprocess.run, cmd, shell=True): cmd for cmd in cmds}
+        for future in concurrent.futures.as_completed(futures):
+            if future.result().returncode:
+                logging.error("fitlins failed: %s" % futures[future])
+                failed.append(futures[future])
+    return failed
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    os.makedirs(args.output_path, exist_ok=True)
+
+    # host layout, only used to plan the jobs
+    layout = bids.BIDSLayout(
+        args.bids_path,
+        database_path=os.path.join(args.bids_path, PYBIDS_CACHE_PATH),
+        reset_database=args.force_reindex,
+        index_metadata=False,
+        validate=False)
+
+    design_cache = load_design_cache(args.output_path)
+    cmds = plan_jobs(layout, args, design_cache)
+    logging.info("%d subject/session/task to fit" % len(cmds))
+    if not cmds:
+        return
+
+    index_in_container(args, layout)
+    if args.slurm:
+        job_path = write_array_job(layout, cmds, args)
+        if not args.no_submit:
+            subprocess.run(["sbatch", job_path], check=True)
+    else:
+        failed = run_local(cmds, args.nprocs)
+        if failed:
+            exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+import os
+import re
+import sys
+import glob
+import sqlite3
+import argparse
+import logging
+import concurrent.futures
+import nibabel as nb
+import nibabel.processing
+import numpy as np
+
+script_dir = os.path.dirname(__file__)
+sys.path.insert(0, os.path.join(script_dir, '..', 'fmriprep'))
+from confounds import load_confounds
+
+QC_DB = 'qc_metrics.sqlite'
+DEFAULT_SPACE = 'MNI152NLin2009cAsym'
+FD_THRESHOLD = 0.5
+TIME_CHUNK = 50
+
+ENTITIES = ['subject', 'session', 'task', 'run']
+ENTITY_REGEXES = {
+    'subject': 'sub-([a-zA-Z0-9]+)',
+    'session': 'ses-([a-zA-Z0-9]+)',
+    'task': 'task-([a-zA-Z0-9]+)',
+    'run': 'run-([a-zA-Z0-9]+)',
+}
+METRICS = [
+    'n_volumes', 'tsnr_median', 'tsnr_mean',
+    'dvars_mean', 'dvars_max',
+    'fd_mean', 'fd_max', 'fd_outliers_prop',
+    'mask_dice']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description='compute per-run QC metrics on fmriprep outputs and store them in a sqlite table')
+    parser.add_argument('derivatives_path',
+                   help='fmriprep derivatives folder.')
+    parser.add_argument(
+        '--anat-derivatives', action='store',
+        help='fmriprep anatomical derivatives folder, default is derivatives_path')
+    parser.add_argument(
+        '--participant-label', action='store', nargs='+',
+        help='a space delimited list of participant identifiers or a single '
+             'identifier (the sub- prefix can be removed)')
+    parser.add_argument(
+        '--space', action='store', default=DEFAULT_SPACE,
+        help='output space of the preprocessed bold to compute metrics on')
+    parser.add_argument(
+        '--db', action='store',
+        help='path to the sqlite QC table, default is <derivatives_path>/%s' % QC_DB)
+    parser.add_argument(
+        '--force', action='store_true',
+        help='recompute metrics of runs already in the table')
+    parser.add_argument('--nprocs', action='store', type=int,
+        help='number of processes, default is the number of CPUs')
+    return parser.parse_args()
+
+
+def parse_entities(path):
+    entities = {}
+    for entity, regex in ENTITY_REGEXES.items():
+        match = re.search(regex, os.path.basename(path))
+        entities[entity] = match.group(1) if match else None
+    return entities
+
+
+def find_bolds(derivatives_path, space, subjects=None):
+    subjects = ['sub-%s' % s.replace('sub-', '') for s in subjects] if subjects else ['sub-*']
+    paths = []
+    for sub in subjects:
+        paths.extend(glob.glob(os.path.join(
+            derivatives_path, sub, '**', 'func',
+            '*_space-%s_desc-preproc_bold.nii*' % space), recursive=True))
+    return sorted(paths)
+
+
+def find_anat_mask(anat_derivatives_path, subject, space):
+    masks = sorted(glob.glob(os.path.join(
+        anat_derivatives_path, 'sub-%s' % subject, '**', 'anat',
+        'sub-%s_*space-%s_desc-brain_mask.nii*' % (subject, space)), recursive=True))
+    return masks[0] if len(masks) else None
+
+
+def dice(mask1, mask2):
+    return 2. * np.logical_and(mask1, mask2).sum() / (mask1.sum() + mask2.sum())
+
+
+def bold_metrics(bold, mask):
+    """Compute tSNR and DVARS in the mask, reading the bold in chunks of volumes"""
+    n_vols = bold.shape[-1]
+    n_vox = mask.sum()
+    # running sums for the voxelwise temporal mean and variance
+    vox_sum = np.zeros(n_vox, dtype=np.float64)
+    vox_sqsum = np.zeros(n_vox, dtype=np.float64)
+    dvars = np.zeros(n_vols - 1, dtype=np.float64)
+    prev_vol = None
+    for t0 in range(0, n_vols, TIME_CHUNK):
+        # chunks are read in file order, the gzip stream kept open only moves forward
+        chunk = np.asarray(bold.dataobj[..., t0:t0 + TIME_CHUNK], dtype=np.float32)[mask]
+        vox_sum += chunk.sum(1)
+        vox_sqsum += np.square(chunk, dtype=np.float64).sum(1)
+        if prev_vol is not None:
+            chunk_diff = np.diff(np.column_stack([prev_vol, chunk]), axis=1)
+        else:
+            chunk_diff = np.diff(chunk, axis=1)
+        t_start = t0 - 1 if prev_vol is not None else t0
+        dvars[t_start:t_start + chunk_diff.shape[1]] = np.sqrt(np.mean(np.square(chunk_diff), 0))
+        prev_vol = chunk[:, -1]
+
+    vox_mean = vox_sum / n_vols
+    vox_std = np.sqrt(np.maximum(vox_sqsum / n_vols - vox_mean ** 2, 0))
+    tsnr = vox_mean[vox_std > 0] / vox_std[vox_std > 0]
+    return {
+        'n_volumes': n_vols,
+        'tsnr_median': float(np.median(tsnr)),
+        'tsnr_mean': float(np.mean(tsnr)),
+        'dvars_mean': float(dvars.mean()) if len(dvars) else np.nan,
+        'dvars_max': float(dvars.max()) if len(dvars) else np.nan,
+    }
+
+
+def run_metrics(bold_path, anat_derivatives_path, space):
+    entities = parse_entities(bold_path)
+    # keep the file open so each chunk does not decompress the run from its start again
+    bold = nb.load(bold_path, keep_file_open=True)
+    mask_path = re.sub('_desc-preproc_bold.nii(.gz)?$', '_desc-brain_mask.nii.gz', bold_path)
+    mask_nb = nb.load(mask_path)
+    mask = np.asanyarray(mask_nb.dataobj) > 0
+
+    metrics = bold_metrics(bold, mask)
+
+    confounds_path = re.sub(
+        '_space-%s_desc-preproc_bold.nii(.gz)?$' % space,
+        '_desc-confounds_timeseries.tsv', bold_path)
+    fd = load_confounds(confounds_path, ['framewise_displacement'])['framewise_displacement']
+    fd = fd[np.isfinite(fd)]
+    # FD is n/a for the first volume, there can be none left (eg. single volume runs)
+    metrics.update({
+        'fd_mean': float(fd.mean()) if len(fd) else np.nan,
+        'fd_max': float(fd.max()) if len(fd) else np.nan,
+        'fd_outliers_prop': float((fd > FD_THRESHOLD).mean()) if len(fd) else np.nan,
+    })
+
+    anat_mask_path = find_anat_mask(anat_derivatives_path, entities['subject'], space)
+    metrics['mask_dice'] = np.nan
+    if anat_mask_path:
+        # the anatomical mask is at template resolution, the bold mask at bold resolution
+        anat_mask = nibabel.processing.resample_from_to(
+            nb.load(anat_mask_path), mask_nb, order=0)
+        metrics['mask_dice'] = float(dice(mask, np.asanyarray(anat_mask.dataobj) > 0))
+    else:
+        logging.warning("no anatomical brain mask found for sub-%s in space %s" % (
+            entities['subject'], space))
+
+    return bold_path, entities, metrics
+
+
+def init_db(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS runs ("
+        "path TEXT PRIMARY KEY, %s, mtime REAL, %s)" % (
+            ", ".join("%s TEXT" % e for e in ENTITIES),
+            ", ".join("%s REAL" % m for m in METRICS)))
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS runs_entities ON runs (%s)" % ", ".join(ENTITIES))
+    return conn
+
+
+def computed_runs(conn):
+    return dict(conn.execute("SELECT path, mtime FROM runs"))
+
+
+def store_metrics(conn, path, mtime, entities, metrics):
+    columns = ['path'] + ENTITIES + ['mtime'] + METRICS
+    values = [path] + [entities[e] for e in ENTITIES] + [mtime] + [metrics[m] for m in METRICS]
+    conn.execute(
+        "INSERT OR REPLACE INTO runs (%s) VALUES (%s)" % (
+            ", ".join(columns), ", ".join("?" * len(columns))),
+        values)
+    conn.commit()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    derivatives_path = os.path.abspath(args.derivatives_path)
+    anat_derivatives_path = os.path.abspath(args.anat_derivatives or derivatives_path)
+    conn = init_db(args.db or os.path.join(derivatives_path, QC_DB))
+
+    # only compute metrics for new runs or runs preprocessed again
+    done = {} if args.force else computed_runs(conn)
+    bold_paths = {}
+    for bold_path in find_bolds(derivatives_path, args.space, args.participant_label):
+        rel_path = os.path.relpath(bold_path, derivatives_path)
+        mtime = os.path.getmtime(bold_path)
+        if done.get(rel_path) != mtime:
+            bold_paths[bold_path] = (rel_path, mtime)
+    logging.info("computing QC metrics for %d runs" % len(bold_paths))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.nprocs) as executor:
+        futures = {
+            executor.submit(run_metrics, bold_path, anat_derivatives_path, args.space): bold_path
+            for bold_path in bold_paths}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                bold_path, entities, metrics = future.result()
+            except Exception:
+                logging.exception("failed to compute QC metrics for %s" % futures[future])
+                continue
+            rel_path, mtime = bold_paths[bold_path]
+            store_metrics(conn, rel_path, mtime, entities, metrics)
+            logging.info("%s: tSNR %.1f, FD %.3f" % (rel_path, metrics['tsnr_median'], metrics['fd_mean']))
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+#!/bin/bash
+# check_publish: run publish.py against directory special remotes standing in for the s3 buckets
+# usage: check_publish.sh [<work_dir>]
+# creates a dataset with the same wanted expressions as configure_buckets.sh, publishes it twice
+# (the second run must transfer nothing), checks each remote only received its wanted files
+# and that a file dropped from a remote is sent again
+set -e
+
+work_dir=${1:-$(mktemp -d)}
+publish=$(realpath ${BASH_SOURCE%/*}/publish.py)
+ds_name=cneuromod.check
+
+mkdir -p $work_dir/ds $work_dir/mri $work_dir/mri.sensitive $work_dir/stimuli
+cd $work_dir/ds
+git init -q
+git annex init -q check
+for remote in mri mri.sensitive stimuli ; do
+  git annex initremote -q ${ds_name}.$remote type=directory directory=$work_dir/$remote encryption=none chunk=1MiB
+done
+git annex wanted ${ds_name}.mri "exclude=derivatives/* and exclude=stimuli/* and not metadata=distribution-restrictions=*"
+git annex wanted ${ds_name}.mri.sensitive "exclude=derivatives/* and exclude=stimuli/* and metadata=distribution-restrictions=*"
+git annex wanted ${ds_name}.stimuli "include=stimuli/*"
+
+mkdir -p sub-01/anat sub-01/func stimuli
+for i in $(seq 1 20) ; do
+  head -c 100000 /dev/urandom > sub-01/func/sub-01_run-${i}_bold.nii.gz
+done
+head -c 3000000 /dev/urandom > sub-01/anat/sub-01_T1w.nii.gz
+head -c 1000 /dev/urandom > stimuli/movie.mkv
+git annex add -q .
+git annex metadata -q -s distribution-restrictions=sensitive sub-01/anat/sub-01_T1w.nii.gz
+git commit -qm "check dataset"
+
+python $publish . --jobs 4 --retries 0
+python $publish . --jobs 4 --retries 0 2>&1 | grep -q "cneuromod.check.mri: 0 files"
+
+function check_count(){
+  count=$(git annex find --in=$1 | wc -l)
+  if [ "$count" != "$2" ] ; then
+    echo "FAIL: $1 has $count files, expected $2"
+    exit 1
+  fi
+}
+check_count ${ds_name}.mri 20
+check_count ${ds_name}.mri.sensitive 1
+check_count ${ds_name}.stimuli 1
+git annex find --in=${ds_name}.mri | grep -q T1w && { echo "FAIL: sensitive file in ${ds_name}.mri" ; exit 1 ; }
+
+git annex drop -q --force --from=${ds_name}.mri sub-01/func/sub-01_run-1_bold.nii.gz
+python $publish . --jobs 4 --retries 0 2>&1 | grep -q "cneuromod.check.mri: 1 files"
+check_count ${ds_name}.mri 20
+echo "OK"
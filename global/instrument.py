@@ -0,0 +1,178 @@
+"""Timing spans, counters and peak RSS sampling for ds_prep scripts
+
+Spans and counters are written as JSON lines to the metrics file, one line per
+closed span plus a summary line when the run ends:
+
+    import instrument
+    instrument.configure(metrics_path='deface.jsonl', profile_path='deface.prof')
+    with instrument.span('registration', subject='01'):
+        ...
+    instrument.count('series_defaced')
+
+Without configure() (or the DS_PREP_METRICS/DS_PREP_PROFILE environment
+variables, used when the script is loaded by another tool like heudiconv),
+spans are only logged at debug level.
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import logging
+import resource
+import threading
+import contextlib
+
+METRICS_ENV = 'DS_PREP_METRICS'
+PROFILE_ENV = 'DS_PREP_PROFILE'
+RSS_SAMPLING_INTERVAL = 0.5
+
+lgr = logging.getLogger(__name__)
+
+
+def _current_rss():
+    try:
+        with open('/proc/self/statm', 'r') as fd:
+            return int(fd.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return _peak_rss()
+
+
+def _peak_rss():
+    # ru_maxrss is in kilobytes on linux, bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+class _Span(object):
+
+    def __init__(self, name, path, fields):
+        self.name = name
+        self.path = path
+        self.fields = fields
+        self.start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        self.rss_peak = _current_rss()
+
+
+class Instrumentation(object):
+
+    def __init__(self):
+        self.metrics_fd = None
+        self.profiler = None
+        self.profile_path = None
+        self.run = None
+        self.counters = {}
+        self.totals = {}
+        self.rss_peak = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._open_spans = []
+        self._sampler = None
+        self._stop = threading.Event()
+        self._start = time.perf_counter()
+
+    def configure(self, metrics_path=None, profile_path=None, run=None):
+        metrics_path = metrics_path or os.environ.get(METRICS_ENV)
+        profile_path = profile_path or os.environ.get(PROFILE_ENV)
+        self.run = run or os.path.basename(sys.argv[0])
+        if metrics_path and self.metrics_fd is None:
+            self.metrics_fd = open(metrics_path, 'a')
+        if profile_path and self.profiler is None:
+            import cProfile
+            self.profile_path = profile_path
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        if self._sampler is None:
+            self._sampler = threading.Thread(target=self._sample_rss, daemon=True)
+            self._sampler.start()
+            atexit.register(self.close)
+
+    def _sample_rss(self):
+        while not self._stop.wait(RSS_SAMPLING_INTERVAL):
+            rss = _current_rss()
+            with self._lock:
+                for span in self._open_spans:
+                    span.rss_peak = max(span.rss_peak, rss)
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _emit(self, record):
+        record = dict(record, run=self.run, pid=os.getpid())
+        if self.metrics_fd is not None:
+            with self._lock:
+                self.metrics_fd.write(json.dumps(record, default=str) + '\n')
+                self.metrics_fd.flush()
+        else:
+            lgr.debug(json.dumps(record, default=str))
+
+    @contextlib.contextmanager
+    def span(self, name, **fields):
+        stack = self._stack()
+        path = '/'.join([s.name for s in stack] + [name])
+        span = _Span(name, path, fields)
+        stack.append(span)
+        with self._lock:
+            self._open_spans.append(span)
+        try:
+            yield span
+        finally:
+            stack.pop()
+            elapsed = time.perf_counter() - span.start
+            rss = _current_rss()
+            with self._lock:
+                self._open_spans.remove(span)
+                span.rss_peak = max(span.rss_peak, rss)
+                self.rss_peak = max(self.rss_peak, span.rss_peak)
+                self.totals[path] = self.totals.get(path, 0.) + elapsed
+            self._emit(dict(
+                type='span',
+                name=name,
+                path=path,
+                seconds=round(elapsed, 6),
+                cpu_seconds=round(time.process_time() - span.cpu_start, 6),
+                rss_peak_mb=round(span.rss_peak / 2**20, 1),
+                **span.fields))
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def close(self):
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        with self._lock:
+            summary = dict(
+                type='summary',
+                seconds=round(time.perf_counter() - self._start, 6),
+                rss_peak_mb=round(max(self.rss_peak, _peak_rss()) / 2**20, 1),
+                counters=dict(self.counters),
+                totals={k: round(v, 6) for k, v in self.totals.items()})
+        self._emit(summary)
+        if self.profiler is not None:
+            self.profiler.disable()
+            # pstats dump, can be rendered as a flamegraph with eg. flameprof or snakeviz
+            self.profiler.dump_stats(self.profile_path)
+        if self.metrics_fd is not None:
+            self.metrics_fd.close()
+            self.metrics_fd = None
+
+
+_instrumentation = Instrumentation()
+configure = _instrumentation.configure
+span = _instrumentation.span
+count = _instrumentation.count
+close = _instrumentation.close
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        '--metrics-file', action='store',
+        help='append timing spans, counters and peak RSS as JSON lines to that file')
+    parser.add_argument(
+        '--profile', action='store',
+        help='dump cProfile stats of the whole run to that file')
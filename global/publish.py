@@ -0,0 +1,254 @@
+import os
+import time
+import json
+import argparse
+import logging
+import threading
+import subprocess
+import concurrent.futures
+
+STATE_FILE = 'ds_prep_publish.jsonl'
+MAX_RETRIES = 3
+RETRY_DELAY = 10
+
+# preferred content keywords that are plain git-annex matching options
+WANTED_OPERATORS = {'and': '--and', 'or': '--or', 'not': '--not', '(': '-(', ')': '-)'}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description='publish annexed files missing from special remotes (s3 buckets) with concurrent transfers')
+    parser.add_argument('dataset_path',
+                   help='datalad dataset to publish.')
+    parser.add_argument(
+        '--to', dest='remotes', action='store', nargs='+',
+        help='special remotes to publish to, default is all remotes with a wanted expression')
+    parser.add_argument(
+        '--jobs', action='store', type=int, default=8,
+        help='number of concurrent transfers per remote')
+    parser.add_argument(
+        '--retries', action='store', type=int, default=MAX_RETRIES,
+        help='number of retries of a failed transfer')
+    parser.add_argument(
+        '--git-remote', action='store',
+        help='publish git history to that sibling once the data is transferred')
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help='only report the files that would be transferred')
+    return parser.parse_args()
+
+
+def git_annex(path, *args):
+    return subprocess.run(
+        ['git', 'annex'] + list(args),
+        cwd=path, check=True, capture_output=True, text=True).stdout
+
+
+def annex_remotes_with_wanted(path):
+    remotes = []
+    for remote in subprocess.run(
+            ['git', 'remote'], cwd=path, check=True,
+            capture_output=True, text=True).stdout.split():
+        # git only remotes (eg. origin) have no preferred content
+        wanted = subprocess.run(
+            ['git', 'annex', 'wanted', remote], cwd=path,
+            capture_output=True, text=True).stdout.strip()
+        if wanted:
+            remotes.append(remote)
+    return remotes
+
+
+def wanted_to_matching_options(wanted):
+    """Convert a preferred content expression to git-annex matching options
+
+    eg. "exclude=stimuli/* and not metadata=distribution-restrictions=*"
+    becomes ['--exclude=stimuli/*', '--and', '--not', '--metadata=distribution-restrictions=*']
+    """
+    options = []
+    for token in wanted.replace('(', ' ( ').replace(')', ' ) ').split():
+        if token in WANTED_OPERATORS:
+            options.append(WANTED_OPERATORS[token])
+        elif '=' in token:
+            options.append('--' + token)
+        else:
+            raise ValueError("unsupported preferred content term '%s' in '%s'" % (token, wanted))
+    return options
+
+
+def missing_wanted_keys(path, remote):
+    wanted = git_annex(path, 'wanted', remote).strip()
+    options = ['--not', '--in=%s' % remote]
+    if wanted:
+        options += ['--and', '-('] + wanted_to_matching_options(wanted) + ['-)']
+    # only files with content here can be sent
+    options += ['--and', '--in=here']
+    keys = {}
+    for line in git_annex(path, 'find', '--json', *options).splitlines():
+        record = json.loads(line)
+        keys[record['key']] = {
+            'file': record['file'],
+            'bytesize': int(record.get('bytesize') or 0)}
+    return keys
+
+
+class PublishState(object):
+    """Transferred and failed keys per remote, appended to .git to report failures of previous publish
+
+    git-annex location tracking is the resume point, keys recorded done are not skipped,
+    so content dropped from a bucket or a re-created bucket is sent again.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.join(path, '.git', STATE_FILE)
+        self.lock = threading.Lock()
+        self.state = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as fd:
+                for line in fd:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # last line can be truncated if interrupted while writing
+                        continue
+                    self._set(record['remote'], record['key'], record['success'])
+        self.fd = open(self.path, 'a')
+
+    def remote(self, remote):
+        return self.state.setdefault(remote, {'done': set(), 'failed': set()})
+
+    def _set(self, remote, key, success):
+        remote_state = self.remote(remote)
+        remote_state['failed'].discard(key)
+        remote_state['done' if success else 'failed'].add(key)
+
+    def update(self, remote, key, success):
+        with self.lock:
+            self._set(remote, key, success)
+            self.fd.write(json.dumps({'remote': remote, 'key': key, 'success': success}) + '\n')
+            self.fd.flush()
+
+    def close(self):
+        self.fd.close()
+
+
+class AnnexCopyBatch(object):
+    """Long-running `git annex copy --batch-keys`, the remote is only initialized once"""
+
+    def __init__(self, path, remote):
+        self.path = path
+        self.remote = remote
+        self.proc = None
+
+    def copy(self, key):
+        if self.proc is None or self.proc.poll() is not None:
+            self.proc = subprocess.Popen(
+                ['git', 'annex', 'copy', '--to=%s' % self.remote,
+                 '--batch-keys', '--json', '--json-error-messages'],
+                cwd=self.path, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL, text=True, bufsize=1)
+        try:
+            self.proc.stdin.write(key + '\n')
+            self.proc.stdin.flush()
+            line = self.proc.stdout.readline()
+        except BrokenPipeError:
+            line = ''
+        if not line:
+            self.close()
+            return False, 'git annex copy exited'
+        # an empty line is output for keys already in the remote
+        if not line.strip():
+            return True, None
+        record = json.loads(line)
+        return record.get('success', False), ' '.join(
+            record.get('error-messages', []) + [record.get('note', '')]).strip()
+
+    def close(self):
+        if self.proc is not None:
+            self.proc.stdin.close()
+            self.proc.wait()
+            self.proc = None
+
+
+def transfer_key(batch, key, retries):
+    for attempt in range(retries + 1):
+        success, error = batch.copy(key)
+        if success:
+            return True
+        logging.warning("transfer of %s to %s failed (attempt %d): %s" % (
+            key, batch.remote, attempt + 1, error))
+        if attempt < retries:
+            time.sleep(RETRY_DELAY * (attempt + 1))
+    return False
+
+
+def publish_remote(path, remote, state, jobs, retries, dry_run=False):
+    keys = missing_wanted_keys(path, remote)
+    retried = state.remote(remote)['failed'].intersection(keys)
+    if retried:
+        logging.info("%s: retrying %d files that failed in a previous publish" % (remote, len(retried)))
+    total_bytes = sum(v['bytesize'] for v in keys.values())
+    logging.info("%s: %d files (%.2f GiB) to transfer" % (remote, len(keys), total_bytes / 2**30))
+    if dry_run:
+        for key in keys.values():
+            print(remote, key['file'])
+        return
+
+    # one batch copy process per worker thread
+    worker = threading.local()
+    batches = []
+
+    def transfer(key):
+        if not hasattr(worker, 'batch'):
+            worker.batch = AnnexCopyBatch(path, remote)
+            batches.append(worker.batch)
+        return transfer_key(worker.batch, key, retries)
+
+    transferred_bytes, failed = 0, []
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(transfer, key): key for key in keys}
+        for future in concurrent.futures.as_completed(futures):
+            key = futures[future]
+            success = future.result()
+            state.update(remote, key, success)
+            if success:
+                transferred_bytes += keys[key]['bytesize']
+            else:
+                failed.append(keys[key]['file'])
+    elapsed = time.time() - start
+    for batch in batches:
+        batch.close()
+
+    logging.info("%s: transferred %.2f GiB in %.0fs (%.1f MiB/s), %d failed" % (
+        remote, transferred_bytes / 2**30, elapsed,
+        transferred_bytes / 2**20 / max(elapsed, 1e-6), len(failed)))
+    for f in failed:
+        logging.error("%s: failed to transfer %s" % (remote, f))
+    return failed
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    path = os.path.abspath(args.dataset_path)
+    remotes = args.remotes or annex_remotes_with_wanted(path)
+    state = PublishState(path)
+
+    failed = {}
+    for remote in remotes:
+        failed[remote] = publish_remote(path, remote, state, args.jobs, args.retries, args.dry_run)
+    state.close()
+
+    if args.git_remote and not args.dry_run:
+        # content is already in the buckets, only push git and git-annex branches
+        import datalad.api
+        datalad.api.publish(dataset=path, to=args.git_remote, transfer_data='none')
+
+    if any(failed.values()):
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,21 @@
-import os, re
+import os, re, sys
+from collections import OrderedDict
 import nibabel.nicom.dicomwrappers as nb_dw
 from heudiconv.heuristics import reproin
-from heudiconv.heuristics.reproin import OrderedDict, create_key, get_dups_marked, parse_series_spec, sanitize_str, lgr, series_spec_fields
+from heudiconv.heuristics.reproin import create_key, get_dups_marked, parse_series_spec, sanitize_str, lgr, series_spec_fields
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../../global'))
+try:
+    import instrument
+    # heuristics are loaded by heudiconv, metrics/profile paths are set with DS_PREP_METRICS/DS_PREP_PROFILE
+    if os.environ.get(instrument.METRICS_ENV) or os.environ.get(instrument.PROFILE_ENV):
+        instrument.configure()
+except ImportError:
+    # the heuristic file can be used alone (eg. bound in a heudiconv container), without instrumentation
+    import contextlib
+    class instrument(object):
+        span = staticmethod(lambda name, **fields: contextlib.nullcontext())
+        count = staticmethod(lambda name, n=1: None)
 
 def infotoids(seqinfos, outdir):
 
@@ -186,6 +200,11 @@ def infotodict(seqinfo):
     """
 
     lgr.info("Processing %d seqinfo entries", len(seqinfo))
+    with instrument.span('infotodict', seqinfos=len(seqinfo)):
+        return _infotodict(seqinfo)
+
+
+def _infotodict(seqinfo):
 
     #for s in seqinfo:
     #    print(s)
@@ -205,11 +224,13 @@ def infotodict(seqinfo):
 
     for s in seqinfo:
 
-        ex_dcm  = nb_dw.wrapper_from_file(s.example_dcm_file_path)
+        instrument.count('series')
+        with instrument.span('read_dicom_header'):
+            ex_dcm  = nb_dw.wrapper_from_file(s.example_dcm_file_path)
 
         bids_info = get_seq_bids_info(s, ex_dcm)
-        print(s)
-        print(bids_info)
+        lgr.debug("%s", s)
+        lgr.debug("%s", bids_info)
 
         # XXX: skip derived sequences, we don't store them to avoid polluting
         # the directory, unless it is the motion corrected ones
@@ -305,5 +326,5 @@ def infotodict(seqinfo):
     info = dict(info)  # convert to dict since outside functionality depends on it being a basic dict
 
     for k,i in info.items():
-        print(k,i)
+        lgr.debug("%s %s", k, i)
     return info
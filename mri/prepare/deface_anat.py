@@ -1,4 +1,5 @@
 import os
+import sys
 import json
 import bids
 import argparse
@@ -18,10 +19,31 @@ from dipy.align.transforms import (AffineTransform3D, RigidTransform3D)
 
 from nipype.interfaces import fsl
 
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../../global'))
+import instrument
+
 
 PYBIDS_CACHE_PATH = '.pybids_cache'
 MNI_PATH = '../../global/templates/MNI152_T1_1mm.nii.gz'
 
+# fast registration: pyramid levels and defaults
+FAST_SIGMAS = [5.0, 3.0, 1.0, 0]
+FAST_FACTORS = [8, 4, 2, 1]
+FAST_LEVEL_ITERS = [1000, 200, 50, 10]
+FAST_STOP_FACTOR = 2
+# mm, the deface mask does not need to be placed more precisely than that
+FAST_TOLERANCE = 2.
+FAST_SAMPLING_PROP = 0.2
+# half-size of the box (mm) on which affine convergence is measured
+CONVERGENCE_BOX = 90.
+
+# subject templates are not BIDS, keep them out of the layout, they are not defaced
+# so they are tagged sensitive when stored in the dataset
+SUBJECT_TEMPLATE_DIR = 'sourcedata/deface_templates'
+RIGID_SIGMAS = [3.0, 1.0]
+RIGID_FACTORS = [4, 2]
+RIGID_LEVEL_ITERS = [200, 50]
+
 def parse_args():
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawTextHelpFormatter,
@@ -53,7 +75,40 @@ def parse_args():
         '--other-bids-filters', dest='other_bids_filters', action='store',
         type=_bids_filter,
         help="path to or inline json with pybids filters to select all images to deface")
-    return parser.parse_args()
+    parser.add_argument(
+        '--fast-registration', action='store_true',
+        help='coarse-to-fine registration with sparse MI sampling, stopping once the affine converges')
+    parser.add_argument(
+        '--registration-stop-factor', action='store', type=int, default=FAST_STOP_FACTOR,
+        choices=FAST_FACTORS,
+        help='finest pyramid downsampling factor fast registration can reach, the tolerance usually stops it earlier')
+    parser.add_argument(
+        '--registration-tol', action='store', type=float, default=FAST_TOLERANCE,
+        help='fast registration stops when the affine moves points less than that (mm) between pyramid levels')
+    parser.add_argument(
+        '--sampling-prop', action='store', type=float, default=FAST_SAMPLING_PROP,
+        help='proportion of voxels sampled for MI at downsampled pyramid levels in fast registration')
+    parser.add_argument(
+        '--subject-template', action='store_true',
+        help='register the first session reference of each subject to the template once, '
+             'then only rigidly register other sessions to that subject template')
+    parser.add_argument(
+        '--subject-template-dir', action='store',
+        help='folder to store the (not defaced) subject templates, outside the dataset, '
+             'default is <bids_path>/%s which requires --datalad' % SUBJECT_TEMPLATE_DIR)
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    if args.subject_template and not args.datalad and \
+            _template_dir_in_dataset(args.bids_path, args.subject_template_dir):
+        parser.error('--subject-template stores templates in the dataset, they can only be '
+                     'tagged sensitive with --datalad, or use an outside --subject-template-dir')
+    return args
+
+def _template_dir_in_dataset(bids_path, template_dir):
+    if template_dir is None:
+        return True
+    bids_path = os.path.realpath(bids_path)
+    return os.path.commonpath([bids_path, os.path.realpath(template_dir)]) == bids_path
 
 def _filter_pybids_any(dct):
     return {k: bids.layout.Query.ANY if v == "*" else v for k, v in dct.items()}
@@ -88,6 +143,155 @@ def registration(ref, moving):
                            starting_affine=rigid.affine)
 
 
+def _affine_displacement(affine1, affine2):
+    # max displacement (mm) of the corners of a head-sized box between two affines
+    corners = np.array(np.meshgrid(*[[-CONVERGENCE_BOX, CONVERGENCE_BOX]]*3)).reshape(3, -1)
+    corners = np.vstack([corners, np.ones(corners.shape[1])])
+    return np.max(np.linalg.norm((affine1 - affine2).dot(corners)[:3], axis=0))
+
+
+def _downsample(data, grid2world, level):
+    factor = FAST_FACTORS[level]
+    level_grid2world = grid2world.dot(np.diag([factor] * 3 + [1]))
+    level_shape = tuple(np.maximum(np.array(data.shape) // factor, 1))
+    downsample = AffineMap(None,
+                           domain_grid_shape=level_shape,
+                           domain_grid2world=level_grid2world,
+                           codomain_grid_shape=data.shape,
+                           codomain_grid2world=grid2world)
+    return downsample.transform(data), level_grid2world
+
+
+def fast_registration(ref, moving,
+                      stop_factor=FAST_STOP_FACTOR,
+                      tol=FAST_TOLERANCE,
+                      sampling_prop=FAST_SAMPLING_PROP):
+    ref_data = ref.get_fdata(dtype=np.float32)
+    mov_data = moving.get_fdata(dtype=np.float32)
+    c_of_mass = transform_centers_of_mass(ref_data, ref.affine,
+                                          mov_data, moving.affine)
+    nbins = 32
+    last_level = FAST_FACTORS.index(stop_factor)
+    pyramid = []
+    starting_affine = c_of_mass.affine
+    # rigid at the coarsest level only, affine is then refined level by level from there
+    for transform, levels in [(RigidTransform3D(), [0]),
+                              (AffineTransform3D(), range(last_level + 1))]:
+        for level in levels:
+            # each pyramid level is built once when first reached, dipy would otherwise smooth
+            # the full resolution images at each call. As in dipy, the reference is downsampled
+            # and the moving image only smoothed
+            if level == len(pyramid):
+                pyramid.append((
+                    _downsample(scipy.ndimage.gaussian_filter(ref_data, FAST_SIGMAS[level]), ref.affine, level),
+                    scipy.ndimage.gaussian_filter(mov_data, FAST_SIGMAS[level])))
+            (ref_level, ref_grid2world), mov_level = pyramid[level]
+            # sparse sampling at downsampled levels, dense at full resolution
+            metric = MutualInformationMetric(
+                nbins, sampling_prop if FAST_FACTORS[level] > 1 else None)
+            affreg = AffineRegistration(metric=metric,
+                                        level_iters=[FAST_LEVEL_ITERS[level]],
+                                        sigmas=[0],
+                                        factors=[1],
+                                        verbosity=0)
+            affine_map, _, fopt = affreg.optimize(
+                ref_level, mov_level, transform, None,
+                ref_grid2world, moving.affine,
+                starting_affine=starting_affine,
+                ret_metric=True)
+            displacement = _affine_displacement(affine_map.affine, starting_affine)
+            starting_affine = affine_map.affine
+            if isinstance(transform, AffineTransform3D) and level > 0 and displacement < tol:
+                break
+    affine_map = AffineMap(starting_affine,
+                           domain_grid_shape=ref.shape,
+                           domain_grid2world=ref.affine,
+                           codomain_grid_shape=moving.shape,
+                           codomain_grid2world=moving.affine)
+    # MI is minimized as its negative
+    return affine_map, -fopt, FAST_FACTORS[level]
+
+
+def _head_mask(data):
+    return data > 0.1 * np.percentile(data, 99)
+
+
+def mask_overlap_qc(ref, moving, affine):
+    # dice between the template head mask and the registered image head mask
+    moving_reg = affine.transform(
+        _head_mask(moving.get_fdata(dtype=np.float32)).astype(np.float32),
+        interpolation='nearest',
+        image_grid2world=moving.affine,
+        sampling_grid_shape=ref.shape,
+        sampling_grid2world=ref.affine) > 0
+    ref_mask = _head_mask(ref.get_fdata(dtype=np.float32))
+    return 2. * np.logical_and(ref_mask, moving_reg).sum() / (ref_mask.sum() + moving_reg.sum())
+
+
+def template_registration(tmpl_image, ref_image_nb, args, span, name):
+    if not args.fast_registration:
+        return registration(tmpl_image, ref_image_nb)
+    ref2tpl_affine, mi, factor = fast_registration(
+        tmpl_image, ref_image_nb,
+        args.registration_stop_factor,
+        args.registration_tol,
+        args.sampling_prop)
+    qc_dice = mask_overlap_qc(tmpl_image, ref_image_nb, ref2tpl_affine)
+    span.fields.update(mi=mi, stop_factor=factor, mask_dice=qc_dice)
+    logging.info("%s: registration MI %.4f at factor %d, head mask dice %.3f",
+        name, mi, factor, qc_dice)
+    return ref2tpl_affine
+
+
+def rigid_registration(ref, moving, starting_affine, sampling_prop=FAST_SAMPLING_PROP):
+    ref_data = ref.get_fdata(dtype=np.float32)
+    mov_data = moving.get_fdata(dtype=np.float32)
+    metric = MutualInformationMetric(32, sampling_prop)
+    affreg = AffineRegistration(metric=metric,
+                                level_iters=RIGID_LEVEL_ITERS,
+                                sigmas=RIGID_SIGMAS,
+                                factors=RIGID_FACTORS,
+                                verbosity=0)
+    return affreg.optimize(ref_data, mov_data, RigidTransform3D(), None,
+                           ref.affine, moving.affine,
+                           starting_affine=starting_affine)
+
+
+def subject_template_registration(template_dir, ref_image, ref_image_nb, tmpl_image, args, span):
+    subject = ref_image.entities['subject']
+    os.makedirs(template_dir, exist_ok=True)
+    prefix = os.path.join(template_dir, 'sub-%s_desc-deface' % subject)
+    sub_tpl_path = prefix + '_T1w.nii.gz'
+    sub2tpl_path = prefix + '_T1w_to-MNI.mat'
+    last_rigid_path = prefix + '_lastsession_rigid.mat'
+
+    if not os.path.exists(sub_tpl_path):
+        # the first reference becomes the subject template, copied before being defaced
+        span.fields.update(subject_template='created')
+        ref_image_nb.to_filename(sub_tpl_path)
+        sub2tpl = template_registration(tmpl_image, ref_image_nb, args, span, sub_tpl_path)
+        np.savetxt(sub2tpl_path, sub2tpl.affine)
+        np.savetxt(last_rigid_path, np.eye(4))
+        return sub2tpl, [sub_tpl_path, sub2tpl_path, last_rigid_path]
+
+    # rigid to the subject template, starting from the previous session head placement
+    span.fields.update(subject_template='reused')
+    sub_tpl = nb.load(sub_tpl_path)
+    rigid = rigid_registration(sub_tpl, ref_image_nb, np.loadtxt(last_rigid_path))
+    # replace the locked annexed file if previously saved with datalad
+    if os.path.islink(last_rigid_path):
+        os.unlink(last_rigid_path)
+    np.savetxt(last_rigid_path, rigid.affine)
+    # compose template->subject template and subject template->session
+    ref2tpl_affine = AffineMap(
+        rigid.affine.dot(np.loadtxt(sub2tpl_path)),
+        domain_grid_shape=tmpl_image.shape,
+        domain_grid2world=tmpl_image.affine,
+        codomain_grid_shape=ref_image_nb.shape,
+        codomain_grid2world=ref_image_nb.affine)
+    return ref2tpl_affine, [last_rigid_path]
+
+
 def output_debug_images(ref, moving, affine):
     moving_reg = affine.transform(
         moving.get_fdata(),
@@ -115,19 +319,25 @@ def warp_mask(tpl_mask, target, affine):
 def main():
 
     args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    instrument.configure(args.metrics_file, args.profile)
 
     pybids_cache_path = os.path.join(args.bids_path, PYBIDS_CACHE_PATH)
 
-    layout = bids.BIDSLayout(
-        args.bids_path,
-        database_path=pybids_cache_path,
-        reset_database=args.force_reindex,
-        index_metadata=False,
-        validate=False)
+    with instrument.span('layout_indexing'):
+        layout = bids.BIDSLayout(
+            args.bids_path,
+            database_path=pybids_cache_path,
+            reset_database=args.force_reindex,
+            index_metadata=False,
+            validate=False)
 
     if args.datalad:
         annex_repo = AnnexRepo(args.bids_path)
 
+    template_dir = args.subject_template_dir or os.path.join(args.bids_path, SUBJECT_TEMPLATE_DIR)
+    template_in_dataset = _template_dir_in_dataset(args.bids_path, template_dir)
+
     subject_list = args.participant_label if args.participant_label else bids.layout.Query.ANY
     deface_ref_images = layout.get(
         subject=subject_list,
@@ -139,59 +349,79 @@ def main():
     script_dir = os.path.dirname(__file__)
 
     mni_path = os.path.abspath(os.path.join(script_dir, MNI_PATH))
-    # if the MNI template image is not available locally
-    if not os.path.exists(os.path.realpath(mni_path)):
-        datalad.api.get(mni_path, dataset=datalad.api.Dataset(script_dir+'/../../'))
-    tmpl_image = nb.load(mni_path)
-    tmpl_defacemask = generate_deface_ear_mask(tmpl_image)
+    with instrument.span('template'):
+        # if the MNI template image is not available locally
+        if not os.path.exists(os.path.realpath(mni_path)):
+            datalad.api.get(mni_path, dataset=datalad.api.Dataset(script_dir+'/../../'))
+        tmpl_image = nb.load(mni_path)
+        tmpl_defacemask = generate_deface_ear_mask(tmpl_image)
 
     for ref_image in deface_ref_images:
         subject = ref_image.entities['subject']
         session = ref_image.entities['session']
 
-        ref_image_nb = ref_image.get_image()
-        ref2tpl_affine = registration(tmpl_image, ref_image_nb)
-        matrix_path = ref_image.path.replace(
-            '_%s.%s'%(ref_image.entities['suffix'],ref_image.entities['extension']),
-            '_mod-%s_defacemaskreg.mat'%ref_image.entities['suffix'])
-        np.savetxt(matrix_path, ref2tpl_affine.affine)
-        new_files.append(matrix_path)
-
-        if args.debug_images:
-            output_debug_images(tmpl_image, ref_image_nb, ref2tpl_affine)
-
-        series_to_deface = []
-        for filters in args.other_bids_filters:
-            series_to_deface.extend(layout.get(
-                extension=['nii','nii.gz'],
-                subject=subject, session=session, **filters))
-
-        for serie in series_to_deface:
-            if args.datalad:
-                if next(annex_repo.get_metadata(serie.path))[1].get('distribution-restrictions') is None:
-                    continue
-                datalad.api.unlock(serie.path)
-
-            serie_nb = serie.get_image()
-            warped_mask = warp_mask(tmpl_defacemask, serie_nb, ref2tpl_affine)
-            if args.save_all_masks or serie == ref_image:
-                warped_mask_path = serie.path.replace(
-                    '_%s'%serie.entities['suffix'],
-                    '_mod-%s_defacemask'%serie.entities['suffix'])
-                warped_mask.to_filename(warped_mask_path)
-                new_files.append(warped_mask_path)
-
-            masked_serie = nb.Nifti1Image(
-                np.asanyarray(serie_nb.dataobj) * np.asanyarray(warped_mask.dataobj),
-                serie_nb.affine,
-                serie_nb.header)
-            masked_serie.to_filename(serie.path)
-            modified_files.append(serie.path)
-
+        with instrument.span('session', subject=subject, session=session):
+            with instrument.span('registration') as reg_span:
+                ref_image_nb = ref_image.get_image()
+                if args.subject_template:
+                    ref2tpl_affine, template_files = subject_template_registration(
+                        template_dir, ref_image, ref_image_nb, tmpl_image, args, reg_span)
+                    if template_in_dataset:
+                        # saved and tagged right away, so they are never published with the defaced data
+                        with instrument.span('datalad_save', files=len(template_files)):
+                            datalad.api.save(template_files, message='update deface subject template sub-%s'%subject)
+                            annex_repo.set_metadata(template_files, add={'distribution-restrictions': 'sensitive'})
+                else:
+                    ref2tpl_affine = template_registration(
+                        tmpl_image, ref_image_nb, args, reg_span, ref_image.path)
+            matrix_path = ref_image.path.replace(
+                '_%s.%s'%(ref_image.entities['suffix'],ref_image.entities['extension']),
+                '_mod-%s_defacemaskreg.mat'%ref_image.entities['suffix'])
+            np.savetxt(matrix_path, ref2tpl_affine.affine)
+            new_files.append(matrix_path)
+
+            if args.debug_images:
+                output_debug_images(tmpl_image, ref_image_nb, ref2tpl_affine)
+
+            series_to_deface = []
+            for filters in args.other_bids_filters:
+                series_to_deface.extend(layout.get(
+                    extension=['nii','nii.gz'],
+                    subject=subject, session=session, **filters))
+
+            for serie in series_to_deface:
+                if args.datalad:
+                    with instrument.span('annex_unlock'):
+                        if next(annex_repo.get_metadata(serie.path))[1].get('distribution-restrictions') is None:
+                            continue
+                        datalad.api.unlock(serie.path)
+
+                with instrument.span('load_serie'):
+                    serie_nb = serie.get_image()
+                    serie_data = np.asanyarray(serie_nb.dataobj)
+                with instrument.span('warp_mask'):
+                    warped_mask = warp_mask(tmpl_defacemask, serie_nb, ref2tpl_affine)
+                with instrument.span('write_images'):
+                    if args.save_all_masks or serie == ref_image:
+                        warped_mask_path = serie.path.replace(
+                            '_%s'%serie.entities['suffix'],
+                            '_mod-%s_defacemask'%serie.entities['suffix'])
+                        warped_mask.to_filename(warped_mask_path)
+                        new_files.append(warped_mask_path)
+
+                    masked_serie = nb.Nifti1Image(
+                        serie_data * np.asanyarray(warped_mask.dataobj),
+                        serie_nb.affine,
+                        serie_nb.header)
+                    masked_serie.to_filename(serie.path)
+                modified_files.append(serie.path)
+                instrument.count('series_defaced')
+        instrument.count('sessions_registered')
 
     if args.datalad and len(modified_files):
-        annex_repo.set_metadata(modified_files, remove={'distribution-restrictions': 'sensitive'})
-        datalad.api.save(modified_files + new_files, message='deface %d series/images and update distribution-restrictions'%len(modified_files))
+        with instrument.span('datalad_save', files=len(modified_files)):
+            annex_repo.set_metadata(modified_files, remove={'distribution-restrictions': 'sensitive'})
+            datalad.api.save(modified_files + new_files, message='deface %d series/images and update distribution-restrictions'%len(modified_files))
 
 
 
@@ -211,14 +441,14 @@ def generate_deface_ear_mask(mni):
 
     # remove face
     deface_ear_mask[:,jaw_marker[0]:,:jaw_marker[1]] = 0
-    y_coords = np.round(np.linspace(jaw_marker[0],above_eye_marker[0],above_eye_marker[1]-jaw_marker[1])).astype(np.int)
+    y_coords = np.round(np.linspace(jaw_marker[0],above_eye_marker[0],above_eye_marker[1]-jaw_marker[1])).astype(int)
     for z,y in zip(range(jaw_marker[1], above_eye_marker[1]), y_coords):
         deface_ear_mask[:,y:,z]=0
 
     # remove ears
     deface_ear_mask[:ear_marker[0],:,:ear_marker[1]] = 0
     deface_ear_mask[-ear_marker[0]:,:,:ear_marker[1]] = 0
-    x_coords=np.round(np.linspace(ear_marker[0],ear_marker2[0],ear_marker2[1]-ear_marker[1])).astype(np.int)
+    x_coords=np.round(np.linspace(ear_marker[0],ear_marker2[0],ear_marker2[1]-ear_marker[1])).astype(int)
     for z,x in zip(range(ear_marker[1],ear_marker2[1]),x_coords):
         deface_ear_mask[:x,:,z] = 0
         deface_ear_mask[-x:,:,z] = 0
@@ -1,21 +1,36 @@
 import sys, os
 import shutil, stat
+import argparse
 from bids import BIDSLayout
 import json
 import logging
 
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../../global'))
+import instrument
+
 def fill_intended_for(path):
     path = os.path.abspath(path)
-    layout = BIDSLayout(path, validate=False)
-    bolds = layout.get(suffix='bold',extensions='.nii.gz')
+    with instrument.span('layout_indexing'):
+        layout = BIDSLayout(path, validate=False)
+    bolds = layout.get(suffix='bold',extension='.nii.gz')
     json_to_modify = dict()
 
+    with instrument.span('matching', bolds=len(bolds)):
+        match_fieldmaps(path, layout, bolds, json_to_modify)
+
+    logging.debug(json_to_modify)
+    with instrument.span('write_sidecars', sidecars=len(json_to_modify)):
+        write_intended_for(path, json_to_modify)
+
+
+def match_fieldmaps(path, layout, bolds, json_to_modify):
     for bold in bolds:
+        instrument.count('bolds')
         fmaps = layout.get(
             suffix='epi', extension='.nii.gz',
             subject=bold.entities['subject'], session=bold.entities['session'])
 
-        print(bold.path)
+        logging.debug(bold.path)
         shim_settings = bold.tags['ShimSetting'].value
         # First: get epi fieldmaps with similar ShimSetting
         #print(shim_settings)
@@ -24,7 +39,7 @@ def fill_intended_for(path):
             if fm.tags['ShimSetting'].value == shim_settings]
         # Second: if not 2 fmap found we extend our search
         pedirs = set([fm.tags['PhaseEncodingDirection'].value for fm in fmaps_match])
-        print(len(fmaps_match), pedirs)
+        logging.debug("%d fieldmaps matching, pedirs: %s", len(fmaps_match), pedirs)
 
         # Second: if not 2 fmap found we extend our search
         if len(fmaps_match)<2 or len(pedirs)<2:
@@ -35,7 +50,7 @@ def fill_intended_for(path):
                 and fm.tags['global'].value['const']['ImagePositionPatient'] == bold.tags['global'].value['const']['ImagePositionPatient']])
 
             pedirs = set([fm.tags['PhaseEncodingDirection'].value for fm in fmaps_match])
-            print(len(fmaps_match), pedirs)
+            logging.debug("%d fieldmaps matching, pedirs: %s", len(fmaps_match), pedirs)
 
         # get all fmap possible
         if len(fmaps_match)<2 or len(pedirs)<2:
@@ -52,17 +67,20 @@ def fill_intended_for(path):
 
         if not fmaps_match_pe_pos or not fmaps_match_pe_neg:
             logging.error("no matching fieldmaps")
+            instrument.count('bolds_without_fieldmaps')
             continue
         for fmap in [fmaps_match_pe_pos, fmaps_match_pe_neg]:
             if ('IntendedFor' not in fmap.tags) or \
                 (bold.path not in fmap.tags.get('IntendedFor').value):
-                print('adding to IntendedFor')
+                logging.debug('adding to IntendedFor')
+                instrument.count('intended_for_added')
                 fmap_json_path = fmap.get_associations()[0].path
                 if fmap_json_path not in json_to_modify:
                     json_to_modify[fmap_json_path] = []
                 json_to_modify[fmap_json_path].append(os.path.relpath(bold.path,path))
 
-    print(json_to_modify)
+
+def write_intended_for(path, json_to_modify):
     for json_path, intendedfor in json_to_modify.items():
         logging.info("updating %s"%json_path)
         json_path = os.path.join(path, json_path)
@@ -83,6 +101,17 @@ def fill_intended_for(path):
             meta = json.dump(meta, fd, indent=3, sort_keys=True)
         os.chmod(json_path, file_mask)
 
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description='fill IntendedFor of epi fieldmaps with the matching bold series')
+    parser.add_argument('bids_path',
+                   help='BIDS folder to fill IntendedFor in.')
+    instrument.add_arguments(parser)
+    return parser.parse_args()
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
-    fill_intended_for(sys.argv[1])
+    args = parse_args()
+    instrument.configure(args.metrics_file, args.profile)
+    fill_intended_for(args.bids_path)
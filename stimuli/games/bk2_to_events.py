@@ -0,0 +1,172 @@
+import os
+import io
+import csv
+import glob
+import zipfile
+import argparse
+import logging
+import concurrent.futures
+import numpy as np
+
+INPUT_LOG = 'Input Log.txt'
+HEADER = 'Header.txt'
+# nominal frame rates of the emulated consoles (NTSC)
+PLATFORM_FPS = {
+    'Nes': 60.0988,
+    'Snes': 60.0988,
+    'Genesis': 59.922743,
+    'Sms': 59.922743,
+    'Gb': 59.7275,
+    'Gba': 59.7275,
+    'Atari2600': 59.9227,
+    'PCEngine': 59.826,
+}
+DEFAULT_FPS = 60.
+EVENTS_FIELDS = ['onset', 'duration', 'trial_type', 'key']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description='convert gym-retro bk2 movies to BIDS keypress events.tsv, decoding the input log without emulator replay')
+    parser.add_argument('bk2_path', nargs='+',
+                   help='bk2 files or folders containing bk2 files.')
+    parser.add_argument('--output-dir', action='store',
+        help='folder to write events.tsv to, default is next to each bk2 file')
+    parser.add_argument('--fps', action='store', type=float,
+        help='override frame rate used to compute onsets, default is from the bk2 platform')
+    parser.add_argument('--game-variables', action='store', nargs='+',
+        help='replay movies in the emulator (requires gym-retro) and add these game state variables to the events')
+    parser.add_argument('--nprocs', action='store', type=int,
+        help='number of processes, default is the number of CPUs')
+    parser.add_argument('--overwrite', action='store_true',
+        help='overwrite existing events.tsv')
+    return parser.parse_args()
+
+
+def read_bk2(bk2_path):
+    with zipfile.ZipFile(bk2_path) as zf:
+        header = zf.read(HEADER).decode() if HEADER in zf.namelist() else ''
+        input_log = zf.read(INPUT_LOG).decode()
+    header = dict(l.strip().split(' ', 1) for l in header.splitlines() if ' ' in l.strip())
+    return header, input_log
+
+
+def parse_input_log(input_log):
+    """Parse a bk2 input log into button names and a boolean (frames x buttons) array"""
+    buttons, frames = [], []
+    for line in io.StringIO(input_log):
+        line = line.rstrip('\r\n')
+        if line.startswith('LogKey:'):
+            # groups of buttons are prefixed with '#', buttons are separated by '|'
+            groups = [g for g in line[len('LogKey:'):].split('#') if g]
+            buttons = [[b for b in g.split('|') if b] for g in groups]
+        elif line.startswith('|'):
+            frames.append(line.strip('|').replace('|', ''))
+    keys = [b for g in buttons for b in g]
+    if not len(frames):
+        return keys, np.zeros((0, len(keys)), dtype=bool)
+    # decode all frames at once: any character other than '.' is a pressed button
+    chars = np.frombuffer(''.join(frames).encode('ascii'), dtype=np.uint8)
+    if chars.size != len(frames) * len(keys):
+        raise ValueError('input log frames do not match LogKey with %d buttons' % len(keys))
+    pressed = chars.reshape(len(frames), len(keys)) != ord('.')
+    return keys, pressed
+
+
+def button_events(pressed):
+    """Vectorized press/release detection, returns (button, press_frame, release_frame) arrays"""
+    padded = np.zeros((pressed.shape[0] + 2, pressed.shape[1]), dtype=np.int8)
+    padded[1:-1] = pressed
+    transitions = np.diff(padded, axis=0)
+    # nonzero on the transposed array orders transitions by button then frame,
+    # so the n-th press of a button pairs with its n-th release
+    press_btn, press_frame = np.nonzero(transitions.T == 1)
+    _, release_frame = np.nonzero(transitions.T == -1)
+    order = np.argsort(press_frame, kind='stable')
+    return press_btn[order], press_frame[order], release_frame[order]
+
+
+def replay_game_variables(bk2_path, variables):
+    # only import gym-retro when game state is requested, decoding inputs does not need it
+    import retro
+    movie = retro.Movie(bk2_path)
+    env = retro.make(
+        game=movie.get_game(),
+        state=retro.State.NONE,
+        use_restricted_actions=retro.Actions.ALL,
+        players=movie.players)
+    env.initial_state = movie.get_state()
+    env.reset()
+    values = []
+    while movie.step():
+        keys = [movie.get_key(i, p) for p in range(movie.players) for i in range(env.num_buttons)]
+        _, _, _, info = env.step(keys)
+        values.append([info.get(v) for v in variables])
+    env.close()
+    return values
+
+
+def bk2_to_events(bk2_path, events_path, fps=None, game_variables=None):
+    header, input_log = read_bk2(bk2_path)
+    keys, pressed = parse_input_log(input_log)
+    if fps is None:
+        fps = PLATFORM_FPS.get(header.get('Platform'), DEFAULT_FPS)
+
+    btn, press_frame, release_frame = button_events(pressed)
+    onsets = press_frame / fps
+    durations = (release_frame - press_frame) / fps
+
+    fields = list(EVENTS_FIELDS)
+    if game_variables:
+        fields.extend(game_variables)
+        state_values = replay_game_variables(bk2_path, game_variables)
+
+    with open(events_path, 'w', newline='') as fd:
+        writer = csv.writer(fd, delimiter='\t', lineterminator='\n')
+        writer.writerow(fields)
+        for i in range(len(btn)):
+            row = ['%.6f' % onsets[i], '%.6f' % durations[i], 'keypress', keys[btn[i]]]
+            if game_variables:
+                frame = min(press_frame[i], len(state_values) - 1)
+                row.extend(['n/a' if v is None else v for v in state_values[frame]])
+            writer.writerow(row)
+    return events_path, len(btn)
+
+
+def events_path_for(bk2_path, output_dir=None):
+    stem = os.path.basename(bk2_path)[:-len('.bk2')]
+    return os.path.join(output_dir or os.path.dirname(bk2_path), '%s_events.tsv' % stem)
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    bk2_files = []
+    for path in args.bk2_path:
+        if os.path.isdir(path):
+            bk2_files.extend(sorted(glob.glob(os.path.join(path, '**', '*.bk2'), recursive=True)))
+        else:
+            bk2_files.append(path)
+
+    jobs = [(f, events_path_for(f, args.output_dir)) for f in bk2_files]
+    if not args.overwrite:
+        jobs = [(f, e) for f, e in jobs if not os.path.exists(e)]
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.nprocs) as executor:
+        futures = {
+            executor.submit(bk2_to_events, bk2, events, args.fps, args.game_variables): bk2
+            for bk2, events in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                events_path, n_events = future.result()
+                logging.info("%s: %d keypresses" % (events_path, n_events))
+            except Exception:
+                logging.exception("failed to convert %s" % futures[future])
+
+
+if __name__ == "__main__":
+    main()